@@ -1,21 +1,76 @@
 import os
 import openai
 import streamlit as st
+from streamlit.runtime.uploaded_file_manager import UploadedFile
 from concurrent.futures import ThreadPoolExecutor
 import fitz  # PyMuPDF for PDF extraction
 from PIL import Image
 import pytesseract  # Tesseract OCR for image extraction
 import io
+import re
+import string
+import hashlib
+import tempfile
+import threading
+import diskcache  # Persistent on-disk cache for OCR results
 import docx  # python-docx for Word file extraction
 import asyncio
+import aiohttp
 import pandas as pd  # For generating tabulated output
 
 # Set the Tesseract executable path
 pytesseract.pytesseract.tesseract_cmd = r'/usr/bin/tesseract'
 
+# OCR batches already run in parallel Tesseract processes; stop each one from
+# spawning its own OpenMP threads and oversubscribing the cores
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
 # Set the OpenAI API key directly
 openai.api_key = st.secrets["general"]["api_key"]  # Replace with your OpenAI API key
 
+# Cache OCR text on disk, keyed by image content hash, so repeated images skip Tesseract
+ocr_cache = diskcache.Cache("./ocr_cache")
+
+# Cache LLM answers on disk, keyed by question and content hash, evicting least-recently-used entries
+answer_cache = diskcache.Cache("./answer_cache", eviction_policy="least-recently-used")
+
+# Images smaller than this are treated as decorative icons and not OCR'd
+MIN_OCR_IMAGE_BYTES = 2 * 1024
+
+# A page with no text layer whose images cover at least this fraction of it is OCR'd as a whole-page render
+SCANNED_PAGE_MIN_COVERAGE = 0.8
+
+# Resolution bounds for whole-page renders; within them the scan's own resolution is used
+OCR_MIN_RENDER_DPI = 300
+OCR_MAX_RENDER_DPI = 600
+
+# Image formats written straight to Tesseract's image list without re-encoding
+TESSERACT_IMAGE_EXTS = {"png", "jpg", "jpeg", "tif", "tiff", "bmp", "gif", "pnm", "webp"}
+
+# Bound the in-memory extraction cache, which is shared by every session, by entry count and age
+EXTRACTION_CACHE_MAX_ENTRIES = 32
+EXTRACTION_CACHE_TTL = 60 * 60  # seconds
+
+# Character budget for the relevant text extracted from each document
+MAX_TEXT_CHARS = 5000
+
+# Question words ignored when extracting keywords
+COMMON_WORDS = frozenset(["what", "who", "when", "where", "why", "how", "is", "are", "the", "a", "an", "of", "in", "to", "on", "for", "with", "and", "or"])
+
+# Articles and simple prepositions dropped from LLM-bound text; words that can change a
+# statement's meaning (conditions, modals, negations, comparisons, "at least", "by", "from",
+# "with", "for") are kept. Matched case-sensitively so labels like "Class A" or "Exhibit A" survive
+STOPWORDS = frozenset({
+    "a", "an", "the", "The", "of", "about", "into", "through", "in", "on",
+})
+
+WHITESPACE_RE = re.compile(r"[ \t\f\v]+")
+# Only explicit page markers ("Page 3", "Page 3 of 10", "3 of 10"); a bare number may be content
+PAGE_FOOTER_RE = re.compile(r"^\s*(page\s*\d+(\s*of\s*\d+)?|\d+\s*of\s*\d+)\s*$", re.IGNORECASE)
+
+# Maximum number of OpenAI requests in flight at once
+MAX_CONCURRENT_REQUESTS = 50
+
 # Streamlit interface
 def main():
     st.set_page_config(page_title="Dynamic AI-Driven Document Analysis", page_icon=":robot_face:", layout="wide")
@@ -31,16 +86,14 @@ def main():
     if uploaded_files:
         st.subheader("Step 2: Ask Your Custom Question(s)")
         custom_question = st.text_area("Enter your question(s) related to the documents", placeholder="What would you like to know?", height=100)
+        use_ocr = st.checkbox("Read text from images in PDFs (OCR)", value=True, help="Turn off for text-only PDFs to skip the slower OCR pass.")
 
         col1, col2 = st.columns(2)
         with col1:
             if st.button("Generate Answer (Normal)"):
                 if custom_question:
                     with st.spinner("Processing uploaded files and generating answers..."):
-                        keywords = extract_keywords_from_question(custom_question)
-                        combined_text = process_files_with_keywords(uploaded_files, keywords)
-                        questions = custom_question.split("\n")
-                        answers = asyncio.run(generate_answers_for_multiple_questions(questions, combined_text))
+                        answers = asyncio.run(analyze_documents(uploaded_files, custom_question, use_ocr))
                         st.subheader("Answers:")
                         for question, answer in answers.items():
                             if answer:
@@ -54,10 +107,7 @@ def main():
             if st.button("Generate Answer (Tabulated)"):
                 if custom_question:
                     with st.spinner("Processing uploaded files and generating answers..."):
-                        keywords = extract_keywords_from_question(custom_question)
-                        combined_text = process_files_with_keywords(uploaded_files, keywords)
-                        questions = custom_question.split("\n")
-                        answers = asyncio.run(generate_answers_for_multiple_questions(questions, combined_text))
+                        answers = asyncio.run(analyze_documents(uploaded_files, custom_question, use_ocr))
                         table_data = []
                         for question, answer in answers.items():
                             if answer:
@@ -74,83 +124,340 @@ def main():
 
 def extract_keywords_from_question(question):
     """Extract keywords from the custom question using simple heuristics."""
-    common_words = set(["what", "who", "when", "where", "why", "how", "is", "are", "the", "a", "an", "of", "in", "to", "on", "for", "with", "and", "or"])
-    keywords = [word.lower() for word in question.split() if word.lower() not in common_words]
-    return keywords
+    # Strip punctuation only at word ends so "COVID-19", "5,000" or "U.S." keep their inner punctuation
+    words = (word.strip(string.punctuation) for word in question.lower().split())
+    return frozenset(word for word in words if word and word not in COMMON_WORDS)
+
+async def analyze_documents(uploaded_files, custom_question, use_ocr=True):
+    """Extract relevant text from the uploaded files and answer each question, in one event loop."""
+    keywords = extract_keywords_from_question(custom_question)
+    combined_text = await process_files_with_keywords(uploaded_files, keywords, use_ocr)
+    questions = custom_question.split("\n")
+    return await generate_answers_for_multiple_questions(questions, combined_text)
 
-def process_files_with_keywords(uploaded_files, keywords):
+async def process_files_with_keywords(uploaded_files, keywords, use_ocr=True):
     """Process files and extract relevant text based on keywords."""
+    keyword_pattern = compile_keyword_pattern(keywords)
+
     def process_file(uploaded_file):
         file_type = uploaded_file.type
         if file_type == "application/pdf":
-            return extract_pdf_text_with_keywords(uploaded_file, keywords)
+            return extract_pdf_text_with_keywords(uploaded_file, keyword_pattern, use_ocr)
         elif file_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-            return extract_docx_text_with_keywords(uploaded_file, keywords)
+            return extract_docx_text_with_keywords(uploaded_file, keyword_pattern)
         return ""
 
-    with ThreadPoolExecutor() as executor:
-        results = list(executor.map(process_file, uploaded_files))
-    
+    # Extraction is blocking (MuPDF, Tesseract), so run each file in a worker thread
+    results = await asyncio.gather(*(asyncio.to_thread(process_file, uploaded_file) for uploaded_file in uploaded_files))
     combined_text = "\n".join(results)
     return combined_text
 
-def extract_pdf_text_with_keywords(uploaded_file, keywords):
-    """Extract text from PDF and filter based on keywords."""
-    doc = fitz.open(stream=uploaded_file.read(), filetype="pdf")
-    relevant_text = ""
+def hash_uploaded_file(uploaded_file):
+    """Hash an uploaded file by content so cached extraction survives Streamlit reruns."""
+    return hashlib.blake2b(uploaded_file.getvalue(), digest_size=16).digest()
+
+@st.cache_data(show_spinner=False, max_entries=EXTRACTION_CACHE_MAX_ENTRIES, ttl=EXTRACTION_CACHE_TTL, hash_funcs={UploadedFile: hash_uploaded_file})
+def extract_pdf_text(uploaded_file, use_ocr=True):
+    """Extract page text and OCR'd image text from a PDF, in reading order."""
+    # getvalue() hands back the upload's existing bytes without copying and ignores the stream position
+    pdf_bytes = uploaded_file.getvalue()
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    page_texts = []
+    page_images = []  # (page_num, image_bytes, ext) for every distinct embedded image
+    scanned_pages = []  # (page_num, dpi) for pages that are OCR'd from a full-page render
+    seen_xrefs = set()
+
+    for page_num, page in enumerate(doc):
+        # Text blocks skip the layout reflow of the default "text" mode; block[6] == 0 marks text (not image) blocks
+        page_texts.append("\n".join(block[4] for block in page.get_text("blocks") if block[6] == 0))
 
-    for page_num in range(len(doc)):
-        page = doc.load_page(page_num)
-        raw_text = page.get_text("text")
-        relevant_text += filter_text_by_keywords(raw_text, keywords)
+        if not use_ocr:
+            continue
 
-        # Process images using OCR
         images = page.get_images(full=True)
+        if images and not page_texts[-1].strip():
+            render_dpi = scanned_page_dpi(page)
+            if render_dpi:
+                # Scanned page with no text layer: OCR a single grayscale render of the whole page
+                # instead of decoding its embedded images one by one
+                scanned_pages.append((page_num, render_dpi))
+                continue
+
+        # Collect images so they can be OCR'd in a single Tesseract run; an image reused
+        # across pages (e.g. a logo) is only extracted and OCR'd where it first appears
         for img_index, img in enumerate(images):
             xref = img[0]
+            if xref in seen_xrefs:
+                continue
+            seen_xrefs.add(xref)
             base_image = doc.extract_image(xref)
-            image_bytes = base_image["image"]
-            img_pil = Image.open(io.BytesIO(image_bytes))
-            ocr_text = pytesseract.image_to_string(img_pil)
-            relevant_text += filter_text_by_keywords(ocr_text, keywords)
+            page_images.append((page_num, base_image["image"], base_image["ext"]))
 
-    return relevant_text[:5000]  # Truncate to optimize API calls
+    page_ocr_texts = [[] for _ in page_texts]
+    ocr_texts = ocr_images([(image_bytes, ext) for _, image_bytes, ext in page_images])
+    for (page_num, _, _), ocr_text in zip(page_images, ocr_texts):
+        page_ocr_texts[page_num].append(ocr_text)
+    if scanned_pages:
+        doc_key = hashlib.blake2b(pdf_bytes, digest_size=16).hexdigest()
+        for (page_num, _), ocr_text in zip(scanned_pages, ocr_scanned_pages(doc, doc_key, scanned_pages)):
+            page_ocr_texts[page_num].append(ocr_text)
 
-def extract_docx_text_with_keywords(uploaded_file, keywords):
-    """Extract text from a DOCX file and filter based on keywords."""
+    segments = []
+    for raw_text, ocr_texts_for_page in zip(page_texts, page_ocr_texts):
+        segments.append(raw_text)
+        segments.extend(ocr_texts_for_page)
+    return segments
+
+def scanned_page_dpi(page):
+    """Return the DPI to render a scanned page at, or None if its images don't cover most of the page."""
+    page_area = page.rect.width * page.rect.height
+    covered_area = 0
+    native_dpi = 0
+    for info in page.get_image_info():
+        bbox = fitz.Rect(info["bbox"]) & page.rect
+        if bbox.is_empty:
+            continue
+        covered_area += bbox.width * bbox.height
+        native_dpi = max(native_dpi, info["width"] * 72 / bbox.width)
+    if not page_area or covered_area / page_area < SCANNED_PAGE_MIN_COVERAGE:
+        return None
+    # Render at the scan's own resolution so small fonts aren't downsampled
+    return int(min(max(native_dpi, OCR_MIN_RENDER_DPI), OCR_MAX_RENDER_DPI))
+
+def extract_pdf_text_with_keywords(uploaded_file, keyword_pattern, use_ocr=True):
+    """Extract text from PDF and filter based on keywords."""
+    return collect_relevant_text(extract_pdf_text(uploaded_file, use_ocr), keyword_pattern)
+
+def ocr_images(images):
+    """Run OCR on (image_bytes, ext) pairs with batched Tesseract invocations, reusing cached text."""
+    ocr_texts = [""] * len(images)
+    pending = {}  # content hash -> indices of images still needing OCR
+    for index, (image_bytes, _) in enumerate(images):
+        if len(image_bytes) < MIN_OCR_IMAGE_BYTES:
+            continue
+        key = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+        cached_text = ocr_cache.get(key)
+        if cached_text is not None:
+            ocr_texts[index] = cached_text
+        else:
+            pending.setdefault(key, []).append(index)
+
+    if not pending:
+        return ocr_texts
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        ocr_keys = []
+        image_paths = []
+        for key, indices in pending.items():
+            image_bytes, ext = images[indices[0]]
+            if ext in TESSERACT_IMAGE_EXTS:
+                image_path = os.path.join(tmp_dir, f"{key}.{ext}")
+                with open(image_path, "wb") as f:
+                    f.write(image_bytes)
+            else:
+                # Formats Tesseract can't read directly (e.g. JPX) are converted via PIL;
+                # Tesseract works on grayscale anyway, so drop colour to shrink the PNG
+                image_path = os.path.join(tmp_dir, f"{key}.png")
+                try:
+                    Image.open(io.BytesIO(image_bytes)).convert("L").save(image_path)
+                except (OSError, ValueError, Image.DecompressionBombError):
+                    continue  # Pillow can't decode it either (e.g. JPEG XR); leave its text empty
+            ocr_keys.append(key)
+            image_paths.append(image_path)
+        batch_texts = ocr_image_files(image_paths, tmp_dir) if image_paths else []
+
+    for key, ocr_text in zip(ocr_keys, batch_texts):
+        ocr_cache.set(key, ocr_text)
+        for index in pending[key]:
+            ocr_texts[index] = ocr_text
+    return ocr_texts
+
+def ocr_scanned_pages(doc, doc_key, scanned_pages):
+    """Run OCR on grayscale renders of (page_num, dpi) pages, reusing cached text."""
+    ocr_texts = [""] * len(scanned_pages)
+    pending = {}  # cache key -> index of a page still needing OCR
+    for index, (page_num, dpi) in enumerate(scanned_pages):
+        key = f"{doc_key}:{page_num}:{dpi}"
+        cached_text = ocr_cache.get(key)
+        if cached_text is not None:
+            ocr_texts[index] = cached_text
+        else:
+            pending[key] = index
+
+    if not pending:
+        return ocr_texts
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        image_paths = []
+        for key, index in pending.items():
+            page_num, dpi = scanned_pages[index]
+            # Each render goes straight to disk so only one page bitmap is held in memory at a time
+            image_path = os.path.join(tmp_dir, f"page_{page_num}.png")
+            doc[page_num].get_pixmap(dpi=dpi, colorspace=fitz.csGRAY).save(image_path)
+            image_paths.append(image_path)
+        batch_texts = ocr_image_files(image_paths, tmp_dir)
+
+    for (key, index), ocr_text in zip(pending.items(), batch_texts):
+        ocr_cache.set(key, ocr_text)
+        ocr_texts[index] = ocr_text
+    return ocr_texts
+
+def ocr_image_files(image_paths, tmp_dir):
+    """Run OCR on image files, split into one image-list batch per core run in parallel."""
+    # Each batch is a separate Tesseract process
+    workers = min(os.cpu_count() or 1, len(image_paths))
+    batch_size = -(-len(image_paths) // workers)
+    batches = [image_paths[i:i + batch_size] for i in range(0, len(image_paths), batch_size)]
+    list_paths = [os.path.join(tmp_dir, f"list_{i}.txt") for i in range(len(batches))]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        batch_results = list(executor.map(ocr_image_list, batches, list_paths))
+    return [ocr_text for result in batch_results for ocr_text in result]
+
+def ocr_image_list(image_paths, list_path):
+    """Run OCR on image files with a single Tesseract invocation using an image list."""
+    with open(list_path, "w") as f:
+        f.write("\n".join(image_paths) + "\n")
+
+    try:
+        output = run_tesseract(list_path)
+    except pytesseract.TesseractError:
+        # Tesseract stops at the first unreadable image in the list
+        return [ocr_image_file(image_path) for image_path in image_paths]
+
+    # Tesseract terminates each image's text with a form feed
+    if output.endswith("\x0c"):
+        output = output[:-1]
+    ocr_texts = output.split("\x0c")
+    if len(ocr_texts) != len(image_paths):
+        # A dropped image would shift every later text, so don't guess the mapping
+        return [ocr_image_file(image_path) for image_path in image_paths]
+    return ocr_texts
+
+def ocr_image_file(image_path):
+    """Run OCR on a single image file, treating an unreadable image as having no text."""
+    try:
+        return run_tesseract(image_path)
+    except pytesseract.TesseractError:
+        return ""
+
+# Cached as a resource so one semaphore is shared across files, reruns and sessions
+@st.cache_resource(show_spinner=False)
+def tesseract_slots():
+    """Cap concurrently running Tesseract processes at the number of cores."""
+    return threading.BoundedSemaphore(os.cpu_count() or 1)
+
+def run_tesseract(image_path):
+    """Run Tesseract on an image or image-list file, waiting for a free slot first."""
+    with tesseract_slots():
+        return pytesseract.image_to_string(image_path)
+
+@st.cache_data(show_spinner=False, max_entries=EXTRACTION_CACHE_MAX_ENTRIES, ttl=EXTRACTION_CACHE_TTL, hash_funcs={UploadedFile: hash_uploaded_file})
+def extract_docx_text(uploaded_file):
+    """Extract the paragraph texts from a DOCX file."""
     doc = docx.Document(uploaded_file)
-    relevant_text = ""
-    for para in doc.paragraphs:
-        raw_text = para.text
-        relevant_text += filter_text_by_keywords(raw_text, keywords)
-    return relevant_text[:5000]
-
-def filter_text_by_keywords(text, keywords):
-    """Filter text to retain lines containing any of the specified keywords."""
+    return [para.text for para in doc.paragraphs]
+
+def extract_docx_text_with_keywords(uploaded_file, keyword_pattern):
+    """Extract text from a DOCX file and filter based on keywords."""
+    return collect_relevant_text(extract_docx_text(uploaded_file), keyword_pattern)
+
+def collect_relevant_text(texts, keyword_pattern, limit=MAX_TEXT_CHARS):
+    """Join lines matching the keyword pattern, stopping at the last whole line within the character budget."""
+    relevant_lines = []
+    total = 0
+    for text in texts:
+        for line in text.splitlines():
+            if not keyword_pattern.search(line):
+                continue
+            total += len(line) + (1 if relevant_lines else 0)  # Count the joining newline
+            if total > limit:
+                # Truncate to optimize API calls; only a single oversized line is cut mid-line
+                return "\n".join(relevant_lines) if relevant_lines else line[:limit]
+            relevant_lines.append(line)
+    return "\n".join(relevant_lines)
+
+def compile_keyword_pattern(keywords):
+    """Compile keywords into a single case-insensitive regex alternation."""
+    if not keywords:
+        return re.compile(r"(?!)")  # Never matches, like any() over no keywords
+    return re.compile("|".join(map(re.escape, keywords)), re.IGNORECASE)
+
+def filter_text_by_keywords(text, keyword_pattern):
+    """Filter text to retain lines matching the compiled keyword pattern."""
     lines = text.splitlines()
-    relevant_lines = [line for line in lines if any(keyword in line.lower() for keyword in keywords)]
+    relevant_lines = [line for line in lines if keyword_pattern.search(line)]
     return "\n".join(relevant_lines)
 
+def reduce_text_for_llm(text, mode="moderate"):
+    """Shrink text sent to the LLM: collapse whitespace and drop page markers ("light"), plus stopwords ("moderate")."""
+    reduced_lines = []
+    for line in text.splitlines():
+        line = WHITESPACE_RE.sub(" ", line).strip()
+        if not line or PAGE_FOOTER_RE.match(line):
+            continue
+        if mode == "moderate":
+            line = " ".join(word for word in line.split(" ") if word not in STOPWORDS)
+        reduced_lines.append(line)
+    return "\n".join(reduced_lines)
+
 async def generate_answers_for_multiple_questions(questions, combined_text):
     """Generate answers for multiple questions using the combined document content."""
-    all_answers = {}
-    for question in questions:
-        answer = await perform_analysis(question, combined_text)
-        all_answers[question] = answer
-    return all_answers
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)  # Bound fan-out to respect API rate limits
+    # Answers being generated in this batch, keyed like answer_cache, so duplicate prompts share one
+    # request; scoped to the batch because its futures belong to this call's event loop
+    inflight_answers = {}
+
+    async def answer(question):
+        # Give each question only the lines matching its own keywords, and skip the API call
+        # entirely when none match
+        question_pattern = compile_keyword_pattern(extract_keywords_from_question(question))
+        question_text = filter_text_by_keywords(combined_text, question_pattern)
+        if not question_text:
+            return ""
+        async with semaphore:
+            return await perform_analysis(question, reduce_text_for_llm(question_text), inflight_answers)
 
-async def perform_analysis(custom_question, combined_text):
+    # Share one pooled HTTP session across all requests so TCP/TLS connections are reused
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=MAX_CONCURRENT_REQUESTS)) as session:
+        openai.aiosession.set(session)
+        results = await asyncio.gather(*(answer(question) for question in questions), return_exceptions=True)
+    # Report failures the same way perform_analysis does rather than as raw exception objects
+    answers = [f"Error occurred: {str(result)}" if isinstance(result, BaseException) else result for result in results]
+    return dict(zip(questions, answers))
+
+async def perform_analysis(custom_question, combined_text, inflight_answers):
     """Answer custom questions based on combined document content."""
+    cache_key = (custom_question, hashlib.blake2b(combined_text.encode(), digest_size=16).hexdigest())
+    cached_answer = answer_cache.get(cache_key)
+    if cached_answer is not None:
+        return cached_answer
+
+    # Identical prompts already in flight share a single API call
+    if cache_key in inflight_answers:
+        return await asyncio.shield(inflight_answers[cache_key])
+    future = asyncio.get_running_loop().create_future()
+    inflight_answers[cache_key] = future
     try:
-        prompt = f"Here is the combined document content:\n\n{combined_text}\n\nQuestion: {custom_question}\nAnswer:"
-        chat_completion = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[{"role": "user", "content": prompt}],
-        )
-        answer = chat_completion['choices'][0]['message']['content'].strip()
-        return answer
+        answer = await request_answer(custom_question, combined_text)
+        answer_cache.set(cache_key, answer)
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
     except Exception as e:
-        return f"Error occurred: {str(e)}"
+        answer = f"Error occurred: {str(e)}"
+    finally:
+        del inflight_answers[cache_key]
+    future.set_result(answer)
+    return answer
+
+async def request_answer(custom_question, combined_text):
+    """Ask the OpenAI model to answer a question over the given document content."""
+    prompt = f"Here is the combined document content:\n\n{combined_text}\n\nQuestion: {custom_question}\nAnswer:"
+    chat_completion = await openai.ChatCompletion.acreate(
+        model="gpt-4",
+        messages=[{"role": "user", "content": prompt}],
+    )
+    return chat_completion['choices'][0]['message']['content'].strip()
 
 if __name__ == "__main__":
     main()